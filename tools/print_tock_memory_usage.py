@@ -20,8 +20,13 @@ Options:
   -s, --show-waste    Show where RAM is wasted (due to padding)
 '''
 
-import os
+import collections
+import dataclasses
+import operator
 import re
+import shlex
+import string
+import subprocess
 import sys
 import getopt
 import cxxfilt   # Demangling C++/Rust symbol names
@@ -34,8 +39,17 @@ show_waste = False
 symbol_depth = 1
 sort_by_size = False # Otherwise lexicographic order
 
-# A map of section name -> size
-sections = {}
+@dataclasses.dataclass
+class Sections:
+    """Sizes of the sections we keep track of. A section that is absent
+       from the ELF has size 0."""
+    text: int = 0
+    relocate: int = 0
+    sram: int = 0
+    stack: int = 0
+    app_memory: int = 0
+
+sections = Sections()
 
 # These lists store 4-tuples:
 #    (name, start address, length of function, total size)
@@ -48,6 +62,19 @@ kernel_uninitialized = []
 kernel_initialized = []
 kernel_functions = []
 
+# Which of the lists above the symbols of each section go into:
+#   relocate: initialized data, part of the flash image, then copied
+#             into RAM on start. The .data section in normal hosted C.
+#   sram:     uninitialized data, stored in a zeroed RAM section. The
+#             .bss section in normal hosted C.
+#   text:     code and embedded data.
+# Symbols in other sections (stack, app_memory) are not recorded.
+section_symbols = {
+    "relocate": kernel_initialized,
+    "sram":     kernel_uninitialized,
+    "text":     kernel_functions,
+}
+
 def usage(message):
     """Prints out an error message and usage"""
     if message != "":
@@ -65,13 +92,19 @@ Note: depends on llvm-objdump to extract symbols""")
 
 
 
-def process_section_line(line):
-    """Parses a line from the Sections: header of an ELF objdump,
-       inserting it into a data structure keeping track of the sections."""
-    # pylint: disable=anomalous-backslash-in-string,line-too-long
-    match = re.search('^\S+\s+\.(text|relocate|sram|stack|app_memory)\s+(\S+).+', line)
-    if match != None:
-        sections[match.group(1)] = int(match.group(2), 16)
+# Lines of the Sections: header and of the SYMBOL TABLE of an ELF objdump
+# for the sections we track. These are matched against the whole objdump
+# output at once, so they only match horizontal whitespace. Addresses and
+# sizes only match hex digits, so converting them with int(..., 16) cannot
+# fail and needs no per-symbol error handling.
+SECTION_LINE = re.compile(r'^[ \t]*\S+[ \t]+\.(text|relocate|sram|stack|app_memory)[ \t]+([0-9a-fA-F]+)[ \t]+\S', re.MULTILINE) # pylint: disable=line-too-long
+SYMBOL_LINE = re.compile(r'^([0-9a-fA-F]+)[ \t]+\w+[ \t]+\w*[ \t]+\.(text|relocate|sram|stack|app_memory)[ \t]+([0-9a-fA-F]+)[ \t]+(.+?)[ \t]*$', re.MULTILINE) # pylint: disable=line-too-long
+
+def process_section(match):
+    """Takes a SECTION_LINE match from the Sections: header of an ELF
+       objdump, inserting it into a data structure keeping track of the
+       sections."""
+    setattr(sections, match.group(1), int(match.group(2), 16))
 
  # Take a Rust-style symbol of '::' delineated names and trim the last
  # one if it is a hash.  Many symbols have hashes appended which just
@@ -79,15 +112,11 @@ def process_section_line(line):
 def trim_hash_from_symbol(symbol):
     """If the passed symbol ends with a hash of the form h[16-hex number]
        trim this and return the trimmed symbol."""
-     # Remove the hash off the end
-    tokens = symbol.split('::')
-    last = tokens[-1]
-    if last[0] == 'h':
-        tokens = tokens[:-1] # Trim off hash if it exists
-        trimmed_name = "::".join(tokens) # reassemble
+    (trimmed_name, separator, last) = symbol.rpartition('::')
+    if (separator and len(last) == 17 and last[0] == 'h' and
+            all(c in string.hexdigits for c in last[1:])):
         return trimmed_name
-    else:
-        return symbol
+    return symbol
 
 escape_sequences = [
     ["$C$",     ","],
@@ -107,6 +136,13 @@ escape_sequences = [
     [".",       "-"]
 ]
 
+# All of the escape sequences as a single regular expression, so a name
+# is scanned once rather than once per escape sequence. Longer sequences
+# come first so that, e.g., '..' is matched before '.'.
+escape_map = dict(escape_sequences)
+escape_regex = re.compile("|".join(re.escape(escape) for escape in
+                                   sorted(escape_map, key=len, reverse=True)))
+
 def parse_mangled_name(name):
     """Take a potentially mangled symbol name and demangle it to its
        name, removing the trailing hash. This is not just a simple
@@ -114,14 +150,14 @@ def parse_mangled_name(name):
        as a :: separated name, eliding the trait (if any)."""
 
     # Trim a trailing . number (e.g., ".71") which breaks demangling
-    match = re.search('\.\d+$', name)
-    if match != None:
-        name = name[:match.start()]
+    suffix = name.rfind(".")
+    if suffix >= 0 and name[suffix + 1:].isdigit():
+        name = name[:suffix]
 
     # Trim a trailing ".llvm", which breaks demangling
-    match = re.search('\.llvm', name)
-    if match != None:
-        name = name[:match.start()]
+    suffix = name.find(".llvm")
+    if suffix >= 0:
+        name = name[:suffix]
 
     demangled = ""
     try:
@@ -130,8 +166,7 @@ def parse_mangled_name(name):
         demangled = name
 
     corrected_name = trim_hash_from_symbol(demangled)
-    for escape in escape_sequences:
-        corrected_name = corrected_name.replace(escape[0], escape[1])
+    corrected_name = escape_regex.sub(lambda m: escape_map[m.group(0)], corrected_name)
 
     # Need to separate the name of the structure from the name of
     # the method. If it starts with a _, then it's of the form
@@ -149,7 +184,7 @@ def parse_mangled_name(name):
         method = corrected_name
 
     structure = full_structure_name
-    if corrected_name[0:1] == "_":
+    if corrected_name.startswith("_"):
         split = full_structure_name.split(" as ")
         structure = split[0]
         # trim the _<
@@ -162,60 +197,42 @@ def parse_mangled_name(name):
         # No structure, just a method
         symbol = method
 
-    if symbol[0:2] == "-L" or symbol[0:2] == "-l" or symbol[0:4] == "anon":
+    if symbol.startswith(("-L", "-l", "anon")):
         symbol = "Anonymous"
-    if symbol[0:7] == "-hidden":
+    if symbol.startswith("-hidden"):
         symbol = "Hidden"
 
     return symbol
 
-def process_symbol_line(line):
-    """Parse a line the SYMBOL TABLE section of the objdump output and
-       insert its data into one of the three kernel_ symbol lists.
-       Because Tock executables have a variety of symbol formats,
-       first try to demangle it; if that fails, use it as is."""
-    # pylint: disable=line-too-long,anomalous-backslash-in-string
-    match = re.search('^(\S+)\s+\w+\s+\w*\s+\.(text|relocate|sram|stack|app_memory)\s+(\S+)\s+(.+)', line)
-    if match != None:
-        addr = int(match.group(1), 16)
-        segment = match.group(2)
-        size = int(match.group(3), 16)
-        name = match.group(4)
-
-        # Initialized data: part of the flash image, then copied into RAM
-        # on start. The .data section in normal hosted C.
-        if segment == "relocate":
-            demangled = parse_mangled_name(name)
-            kernel_initialized.append((demangled, addr, size, 0))
-
-        # Uninitialized data, stored in a zeroed RAM section. The
-        # .bss section in normal hosted C.
-        elif segment == "sram":
-            demangled = parse_mangled_name(name)
-            kernel_uninitialized.append((demangled, addr, size, 0))
-
-        # Code and embedded data.
-        elif segment == "text":
-            match = re.search('\$(((\w+\.\.)+)(\w+))\$', name)
-            if match != None:
-                symbol = parse_mangled_name(name)
-                kernel_functions.append((symbol, addr, size, 0))
-            else:
-                try:
-                    symbol = parse_mangled_name(name)
-                    kernel_functions.append((symbol, addr, size, 0))
-                except cxxfilt.InvalidName:
-                    kernel_functions.append((name, addr, size, 0))
+def process_symbol(match):
+    """Take a SYMBOL_LINE match from the SYMBOL TABLE section of the
+       objdump output and insert its data into one of the three kernel_
+       symbol lists. Because Tock executables have a variety of symbol
+       formats, first try to demangle it; if that fails, use it as is."""
+    symbols = section_symbols.get(match.group(2))
+    if symbols is None:
+        return
+    size = int(match.group(3), 16)
+    name = match.group(4)
+
+    # Zero-sized symbols (e.g., _estack) only matter for their address
+    # when computing padding: their names are never reported, so skip
+    # the comparatively expensive demangling for them.
+    if size != 0:
+        name = parse_mangled_name(name)
+    addr = int(match.group(1), 16)
+
+    symbols.append((name, addr, size, 0))
 
 def print_section_information():
     """Print out the ELF's section information (RAM and Flash use)."""
-    text_size = sections["text"]
-    stack_size = sections["stack"]
-    relocate_size = sections["relocate"]
-    sram_size = sections["sram"]
+    text_size = sections.text
+    stack_size = sections.stack
+    relocate_size = sections.relocate
+    sram_size = sections.sram
     app_size = 0
-    if "app_memory" in sections:  # H1B-style linker file, static app section
-        app_size = sections["app_memory"]
+    if sections.app_memory != 0:  # H1B-style linker file, static app section
+        app_size = sections.app_memory
     else: # Mainline Tock-style linker file, using APP_MEMORY
         for (name, addr, size, tsize) in kernel_uninitialized:
             if name.find("APP_MEMORY") >= 0:
@@ -249,10 +266,9 @@ def print_section_information():
 # Returns a string representation of any detected waste. This is returned
 # as a string to it can be later output.
 def group_symbols(groups, symbols, waste, section):
-    """Take a list of symbols and group them into 'groups' for reporting
-       aggregate flash/RAM use."""
-    global symbol_depth
-    output = ""
+    """Take a list of symbols and group them into 'groups' (a
+       defaultdict(list)) for reporting aggregate flash/RAM use."""
+    output = []
     expected_addr = 0
     waste_sum = 0
     prev_symbol = ""
@@ -263,21 +279,20 @@ def group_symbols(groups, symbols, waste, section):
         # have waste. But this is only true if it's not the first symbol and
         # this is actually a variable and just just a symbol (e.g., _estart)
         if addr != expected_addr and expected_addr != 0 and size != 0 and (waste or verbose):
-            output = output + "   ! " + str(addr - expected_addr) + " bytes of data or padding after " + prev_symbol + "\n"
+            output.append("   ! " + str(addr - expected_addr) + " bytes of data or padding after " + prev_symbol + "\n")
             waste_sum = waste_sum + (addr - expected_addr)
-        tokens = symbol.split("::")
         key = symbol[0] # Default to first character (_) if not a proper symbol
         name = symbol
 
-        if len(tokens) == 1:
+        if "::" not in symbol:
             # The symbol isn't a standard mangled Rust name. These rules are
             # based on observation.
             # .Lanon* and str.* are embedded string.
-            if symbol[0:6] == '.Lanon' or symbol[0:5] == "anon." or symbol[0:4] == 'str.':
+            if symbol.startswith(('.Lanon', 'anon.', 'str.')):
                 key = "Constant strings"
-            elif symbol[0:8] == ".hidden ":
+            elif symbol.startswith(".hidden "):
                 key = "ARM aeabi support"
-            elif symbol[0:3] == "_ZN":
+            elif symbol.startswith("_ZN"):
                 key = "Unidentified auto-generated"
             else:
                 key = "Unmangled globals (C-like code)"
@@ -286,75 +301,63 @@ def group_symbols(groups, symbols, waste, section):
             # Packages have a trailing :: while other categories don't;
             # this allows us to disambiguate when * is relevant or not
             # in printing.
-            key = "::".join(tokens[0:symbol_depth])
-            name = ""
-            
-            if len(tokens[symbol_depth:]) > 0:
-                key = key + "::"
-                name = "::".join(tokens[symbol_depth:])
-
-            if key in groups.keys():
-                groups[key].append((name, size))
+            # Find the '::' ending the first symbol_depth names rather
+            # than splitting the whole symbol and joining it back up. A
+            # depth of 0 leaves split at -2, so the key is just '::'.
+            split = -2
+            for _ in range(symbol_depth):
+                split = symbol.find("::", split + 2)
+                if split == -1:
+                    break
+
+            if split == -1:
+                key = symbol
+                name = ""
             else:
-                groups[key] = [(name, size)]
+                key = symbol[:max(split, 0)] + "::"
+                name = symbol[split + 2:]
+
+            groups[key].append((name, size))
 
         # Set state for next iteration
         expected_addr = addr + size
         prev_symbol = symbol
 
     if waste and waste_sum > 0:
-        output = output + "Total of " + str(waste_sum) + " bytes wasted in " + section + "\n"
+        output.append("Total of " + str(waste_sum) + " bytes wasted in " + section + "\n")
 
-    return output
+    return "".join(output)
 
 def string_for_group(key, padding_size, group_size, num_elements):
     """Return the string for a group of variables, with padding added on the
        right; decides whether to add a * or not based on the name of the group
        and number of elements in it."""
-    if key[-2:] == "::":
+    if key.endswith("::"):
         key = key + "*"
-        key = key.ljust(padding_size + 2, ' ')
-        return ("  " + key + str(group_size) + " bytes\n")
-    else:
-        key = key + ""
-        key = key.ljust(padding_size + 2, ' ')
-        return ("  " + key + str(group_size) + " bytes\n")
+    return "  " + key.ljust(padding_size + 2, ' ') + str(group_size) + " bytes\n"
 
 def print_groups(title, groups):
     """Print title, then all of the variable groups in groups."""
-    group_sum = 0
-    output = ""
-    max_string_len = len(max(groups.keys(), key=len))
-    group_sizes = {}
-
-    for key in groups.keys():
-        symbols = groups[key]
-
-        group_size = 0
-        for (_, size) in symbols:
-            group_size = group_size + size
-        group_sizes[key] = group_size
+    max_string_len = max((len(key) for key in groups), default=0)
+    group_entries = [(key, sum(size for (_, size) in symbols), len(symbols))
+                     for (key, symbols) in groups.items()]
 
     if sort_by_size:
-        for k, v in sorted(group_sizes.items(), key=lambda item: item[1], reverse=True):
-            group_size = v
-            symbols = groups[key]
-            output = output + string_for_group(k, max_string_len, group_size, len(symbols))
-            group_sum = group_sum + group_size
+        group_entries.sort(key=operator.itemgetter(1), reverse=True)
     else:
-        for key in sorted(group_sizes.keys()):
-            group_size = group_sizes[key]
-            symbols = groups[key]
-            output = output + string_for_group(key, max_string_len, group_size, len(symbols))
-            group_sum = group_sum + group_size
+        group_entries.sort(key=operator.itemgetter(0))
 
-    print(title + ": " + str(group_sum) + " bytes")
-    print(output, end = '')
+    group_sum = sum(group_size for (_, group_size, _) in group_entries)
+
+    output = [title + ": " + str(group_sum) + " bytes\n"]
+    for (key, group_size, num_elements) in group_entries:
+        output.append(string_for_group(key, max_string_len, group_size, num_elements))
+    sys.stdout.write("".join(output))
 
 def print_symbol_information():
     """Print out all of the variable and function groups with their flash/RAM
        use."""
-    variable_groups = {}
+    variable_groups = collections.defaultdict(list)
     gaps = group_symbols(variable_groups, kernel_initialized, show_waste, "Flash+RAM")
     gaps = gaps + group_symbols(variable_groups, kernel_uninitialized, show_waste, "RAM")
     print_groups("Variable groups (RAM)", variable_groups)
@@ -362,7 +365,7 @@ def print_symbol_information():
 
     print("Embedded data (flash): " + str(padding_text) + " bytes")
     print()
-    function_groups = {}
+    function_groups = collections.defaultdict(list)
     # Embedded constants in code (e.g., after functions) aren't counted
     # in the symbol's size, so detecting waste in code has too many false
     # positives.
@@ -371,26 +374,25 @@ def print_symbol_information():
     print_groups("Function groups (flash)", function_groups)
     print(gaps)
 
-def get_addr(symbol_entry):
-    """Helper function for sorting symbols by start address."""
-    return symbol_entry[1]
-
 def compute_padding(symbols):
     """Calculate how much padding is in a list of symbols by comparing their
        reporting size with the spacing with the next function and return
        the total differences."""
-    symbols.sort(key=get_addr)
-    func_count = len(symbols)
-    diff = 0
-    for i in range(1, func_count):
-        (esymbol, eaddr, esize, _) = symbols[i - 1]
-        (_, laddr, _, _) = symbols[i]
-        total_size = laddr - eaddr
-        symbols[i - 1] = (esymbol, eaddr, esize, total_size)
-        if total_size != esize:
-            diff = diff + (total_size - esize)
-
-    return diff
+    symbols.sort(key=operator.itemgetter(1))
+    # Work on parallel lists of addresses and sizes rather than unpacking
+    # and repacking a pair of tuples for every symbol.
+    addrs = [addr for (_, addr, _, _) in symbols]
+    sizes = [size for (_, _, size, _) in symbols]
+    total_sizes = [laddr - eaddr for (eaddr, laddr) in zip(addrs, addrs[1:])]
+    symbols[:-1] = [(name, addr, size, total_size) for ((name, addr, size, _), total_size)
+                    in zip(symbols, total_sizes)]
+
+    # The total sizes telescope: together they span from the first symbol
+    # to the last one, so the padding is that span minus the reported
+    # sizes of every symbol but the last.
+    if len(symbols) < 2:
+        return 0
+    return (addrs[-1] - addrs[0]) - sum(sizes[:-1])
 
 def parse_options(opts):
     """Parse command line options."""
@@ -438,41 +440,37 @@ if __name__ == "__main__":
          usage(str(err))
          sys.exit(-1)
 
-    header_lines = os.popen(OBJDUMP + ' -section-headers ' + elf_name).readlines()
-
     print("Tock memory usage report for " + elf_name)
     arch = "UNKNOWN"
 
-    for hline in header_lines:
-        # pylint: disable=anomalous-backslash-in-string
-        hmatch = re.search('file format (\S+)', hline)
-        if hmatch != None:
-            arch = hmatch.group(1)
+    # A single objdump pass provides the file format line (used to detect
+    # the architecture), the section headers and the symbol table. Read
+    # it in one go and scan it with precompiled regular expressions
+    # rather than matching it line by line.
+    objdump = subprocess.run(shlex.split(OBJDUMP) + ['-t', '--section-headers', elf_name],
+                             stdout=subprocess.PIPE, text=True, check=False)
+    (header, _, symbol_table) = objdump.stdout.partition("\nSYMBOL TABLE:\n")
+    (preamble, _, header) = header.partition("\nSections:\n")
+
+    # The file format line comes before the section headers; check it
+    # before spending any time parsing sections and symbols.
+    hmatch = re.search(r'file format (\S+)', preamble)
+    if hmatch != None:
+        arch = hmatch.group(1)
 
     if arch == "UNKNOWN":
         usage("could not detect architecture of ELF")
         sys.exit(-1)
 
-    objdump_lines = os.popen(OBJDUMP + ' -t -section-headers ' + elf_name).readlines()
-    objdump_output_section = "start"
-
-    for oline in objdump_lines:
-        oline = oline.strip()
-        # First, move to a new section if we've reached it; use continue
-        # to break out and reduce nesting.
-        if oline == "Sections:":
-            objdump_output_section = "sections"
-            continue
-        elif oline == "SYMBOL TABLE:":
-            objdump_output_section = "symbol_table"
-            continue
-        elif objdump_output_section == "sections":
-            process_section_line(oline)
-        elif objdump_output_section == "symbol_table":
-            process_symbol_line(oline)
+    for smatch in SECTION_LINE.finditer(header):
+        process_section(smatch)
+    for smatch in SYMBOL_LINE.finditer(symbol_table):
+        process_symbol(smatch)
 
-    padding_init = compute_padding(kernel_initialized)
-    padding_uninit = compute_padding(kernel_uninitialized)
+    # Only the embedded data in flash is reported, but all three lists need
+    # to be sorted by address for grouping to detect waste.
+    compute_padding(kernel_initialized)
+    compute_padding(kernel_uninitialized)
     padding_text = compute_padding(kernel_functions)
 
     print_section_information()
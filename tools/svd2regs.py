@@ -47,7 +47,9 @@
 
 import sys
 import argparse
-from subprocess import Popen, PIPE
+from functools import lru_cache
+from operator import attrgetter
+from subprocess import run, PIPE
 from xml.etree import ElementTree as ET
 
 try:
@@ -64,24 +66,41 @@ except ImportError:
     print('pip install pydentifier')
     sys.exit(1)
 
-RUST_KEYWORDS = ["mod"]
+RUST_KEYWORDS = frozenset(["mod"])
 COMMENT_MAX_LENGTH = 80
+MODE_MAP = {
+    "read-only": "ReadOnly",
+    "read-write": "ReadWrite",
+    "write-only": "WriteOnly",
+}
+
+
+# Register, field and enum names repeat a lot, especially across the
+# instances of a peripheral group, so cache the identifier conversions.
+@lru_cache(maxsize=None)
+def lower_underscore(name):
+    return pydentifier.lower_underscore(name)
+
+
+@lru_cache(maxsize=None)
+def upper_camel(name):
+    return pydentifier.upper_camel(name)
 
 
 def comment(text):
-    if text:
-        lines = text.split ("\n")
-        lines = ["/// {}".format(line[:COMMENT_MAX_LENGTH].strip()) for line in lines]
-        return "\n".join (lines)
-    else:
+    if not text:
         return ""
+    # Slicing a line that is already short enough returns the line itself,
+    # so only long lines are copied before stripping.
+    return "\n".join("/// " + line[:COMMENT_MAX_LENGTH].strip()
+                     for line in text.split("\n"))
 
 
 class CodeBlock(str):
     TEMPLATE = ""
 
     def __new__(cls, *args):
-        return cls.TEMPLATE.format(**cls.fields(*args))
+        return cls.TEMPLATE.format_map(cls.fields(*args))
 
     @staticmethod
     def fields(*args):
@@ -143,12 +162,13 @@ register_structs! {{
         offset = 0
         count_reserved = 0
         for register in sorted(peripheral.registers,
-                               key=lambda r: r.address_offset):
-            if register.address_offset > offset:
+                               key=attrgetter("address_offset")):
+            address_offset = register.address_offset
+            if address_offset > offset:
                 fields.append(ReservedStructField(offset, count_reserved))
                 count_reserved += 1
-                offset = register.address_offset
-            if offset == register.address_offset:
+                offset = address_offset
+            if offset == address_offset:
                 size = get_register_size(register)
                 fields.append(PeripheralStructField(register, size))
                 offset += size / 8
@@ -157,7 +177,7 @@ register_structs! {{
                 print(
                     "Offset Mismatch at register {} ({} != {})".format(
                         register.name,
-                        register.address_offset,
+                        address_offset,
                         offset
                     )
                 )
@@ -175,31 +195,27 @@ class PeripheralStructField(CodeBlock):
         (0x{offset:03X} => {name}: {mode}<u{size}{definition}>),"""
 
     @staticmethod
-    def fields(register, size):
-        def identifier(name):
-            identifier = pydentifier.lower_underscore(name)
-            if identifier in RUST_KEYWORDS:
-                identifier = "{}_".format(identifier)
-            return identifier
-
-        def definition(reg):
-            if len(reg._fields) == 1:
-                return ""
-            return ", {}::Register".format(reg.name)
-
-        mode_map = {
-            "read-only": "ReadOnly",
-            "read-write": "ReadWrite",
-            "write-only": "WriteOnly",
-        }
+    def identifier(name):
+        identifier = lower_underscore(name)
+        if identifier in RUST_KEYWORDS:
+            identifier = "{}_".format(identifier)
+        return identifier
+
+    @staticmethod
+    def definition(reg):
+        if len(reg._fields) == 1:
+            return ""
+        return ", {}::Register".format(reg.name)
 
+    @staticmethod
+    def fields(register, size):
         return {
             "comment": comment(register.description),
             "offset": int(register.address_offset),
-            "name": identifier(register.name),
+            "name": PeripheralStructField.identifier(register.name),
             "size": size,
-            "mode": mode_map.get(register._access, "ReadWrite"),
-            "definition": definition(register),
+            "mode": MODE_MAP.get(register._access, "ReadWrite"),
+            "definition": PeripheralStructField.definition(register),
         }
 
 
@@ -252,8 +268,10 @@ class BitfieldField(CodeBlock):
     @staticmethod
     def enumerated_values(field):
         values = []
+        descriptions = set()
         for value in field.enumerated_values:
-            if value.description not in [v.description for v in values]:
+            if value.description not in descriptions:
+                descriptions.add(value.description)
                 values.append(value)
         return values
 
@@ -284,7 +302,7 @@ class BitfieldFieldEnum(CodeBlock):
             if desc != None:
                 if any(desc.startswith(str(digit)) for digit in range(10)):
                     desc = "_{}".format(desc)
-                i = pydentifier.upper_camel(desc)
+                i = upper_camel(desc)
                 return i if len(i) < 80 else None
             else:
                 return None
@@ -306,35 +324,60 @@ def get_parser(mcu, svd):
     try:
         if mcu:
             return SVDParser.for_packaged_svd(mcu[0], "{}.svd".format(mcu[1]))
-        return SVDParser(ET.ElementTree(ET.fromstring(svd.read())))
+        # SVDParser needs the complete tree: it looks up every peripheral
+        # (including the ones others are derivedFrom) from the root. So
+        # streaming the file with iterparse and clearing elements as we go
+        # is not an option, but ET.parse at least feeds the file to the
+        # parser in chunks rather than reading it into one string first.
+        return SVDParser(ET.parse(svd))
     except IOError:
         print("No SVD file found")
         sys.exit()
 
 
+@lru_cache(maxsize=None)
+def get_packaged_device(vendor, mcu):
+    # Packaged SVDs never change, so when svd2regs is scripted to generate
+    # several peripherals of the same MCU only parse it once.
+    return get_parser((vendor, mcu), None).get_device()
+
+
+@lru_cache(maxsize=None)
+def peripheral_groups(dev):
+    groups = {}
+    for peripheral in dev.peripherals:
+        groups.setdefault(peripheral.group_name, []).append(peripheral)
+    return groups
+
+
 def parse(peripheral_name, mcu, svd, group):
-    svd_parser = get_parser(mcu, svd)
-    dev = svd_parser.get_device()
+    if mcu:
+        dev = get_packaged_device(*mcu)
+    else:
+        dev = get_parser(mcu, svd).get_device()
     if group:
-        flt = lambda p: p.group_name == peripheral_name
+        peripherals = peripheral_groups(dev).get(peripheral_name, [])
     else:
-        flt = lambda p: p.name == peripheral_name
-    return peripheral_name, filter(flt, dev.peripherals), dev
+        # Peripheral names are unique, stop at the first match
+        peripheral = next((p for p in dev.peripherals
+                           if p.name == peripheral_name), None)
+        peripherals = [peripheral] if peripheral else []
+    return peripheral_name, peripherals, dev
 
 
 def generate(name, peripherals, dev):
-    peripherals = list(peripherals)
-
     if len(peripherals) == 0:
         print('Error: no peripheral found.')
         return ''
 
     main_peripheral = peripherals[0]
-    return Includes() \
-           + PeripheralStruct(name, main_peripheral, dev) \
-           + generate_bitfields_macro(main_peripheral.registers) \
-           + "\n".join(PeripheralBaseDeclaration(name, peripheral)
-                       for peripheral in peripherals)
+    return "".join([
+        Includes(),
+        PeripheralStruct(name, main_peripheral, dev),
+        generate_bitfields_macro(main_peripheral.registers),
+        "\n".join(PeripheralBaseDeclaration(name, peripheral)
+                  for peripheral in peripherals),
+    ])
 
 
 def generate_bitfields_macro(registers):
@@ -346,14 +389,14 @@ def generate_bitfields_macro(registers):
 def rustfmt(code, path, *args):
     cmd = ["{}rustfmt".format(path)]
     cmd.extend(args)
-    fmt = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    out, err = fmt.communicate(code)
-    if err:
+    fmt = run(cmd, input=code, stdout=PIPE, stderr=PIPE,
+              universal_newlines=True)
+    if fmt.stderr:
         print(code)
-        print(err)
+        print(fmt.stderr)
         sys.exit()
 
-    return out
+    return fmt.stdout
 
 
 def parse_args():
@@ -380,7 +423,7 @@ def main():
     args = parse_args()
     code = generate(*parse(args.peripheral, args.mcu, args.svd, args.group))
     if args.fmt is not None:
-        code = rustfmt(code, args.path, *args.fmt.strip("'").split(" "))
+        code = rustfmt(code, args.path, *args.fmt.strip("'").split())
     args.save.write(code)
 
 
@@ -15,143 +15,205 @@ Example:
 ```
 '''
 
+import json
 import os
 import re
 
 # Static info of chip crates that just support other chips.
-SUBSUMES = {'nrf52': ['nrf5x'],
-            'e310x': ['sifive'],
-            'arty_e21': ['sifive'],
-            'nrf52840': ['nrf52', 'nrf5x'],
-            'nrf52832': ['nrf52', 'nrf5x'],
-            'lowrisc': ['ibex'],
+SUBSUMES = {'nrf52': {'nrf5x'},
+            'e310x': {'sifive'},
+            'arty_e21': {'sifive'},
+            'nrf52840': {'nrf52', 'nrf5x'},
+            'nrf52832': {'nrf52', 'nrf5x'},
+            'lowrisc': {'ibex'},
             }
 
-
+# Splits a line into words and all other symbols.
+TOKEN_RE = re.compile(r"[A-Za-z0-9]+|\S")
+# These are run over whole files, and find the lines we care about without
+# splitting the file into lines in Python.
+# Matches the name of the trait a `pub trait` line declares.
+TRAIT_RE = re.compile(r"^pub trait[ \t]+([A-Za-z0-9]+|\S)", re.MULTILINE)
+# Matches the text before the first " for " of an `impl ... for ...` line.
+IMPL_RE = re.compile(r"^(impl.*?) for ", re.MULTILINE)
+
+# What was parsed out of each file on the last run, so that files that have
+# not changed do not have to be read again.
+CACHE_PATH = '.cache/update_chip_support.json'
+
+
+def walk_rs(root):
+	'''
+	Yield the `os.DirEntry` of every Rust file under `root`, in the same
+	order as `os.walk`. `os.scandir` already knows the type of each entry,
+	so this needs no extra `stat` per file.
+	'''
+	subdirs = []
+	with os.scandir(root) as it:
+		for entry in it:
+			if entry.is_dir(follow_symlinks=False):
+				subdirs.append(entry.path)
+			elif entry.name.endswith('.rs'):
+				yield entry
+
+	for subdir in subdirs:
+		yield from walk_rs(subdir)
+
+
+def load_cache():
+	'''
+	Return the per-file cache from the last run. It is thrown away if it
+	cannot be read, is not laid out as expected, or this script has changed
+	since then, as the parsing may have changed too.
+	'''
+	try:
+		with open(CACHE_PATH) as f:
+			cache = json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+	if not (isinstance(cache, dict) and
+	        cache.get('script') == script_key and
+	        isinstance(cache.get('files'), dict)):
+		return {}
+	return cache['files']
+
+
+def parse_cached(entry, parse):
+	'''
+	Return `parse` applied to the contents of the file `entry`. The result
+	is reused from the last run if the file's mtime and size are unchanged.
+	'''
+	st = entry.stat(follow_symlinks=False)
+	key = [st.st_mtime_ns, st.st_size]
+
+	cached = old_files.get(entry.path)
+	if (isinstance(cached, list) and len(cached) == 2 and cached[0] == key and
+	    isinstance(cached[1], list)):
+		result = cached[1]
+	else:
+		with open(entry.path) as f:
+			result = parse(f.read())
+
+	new_files[entry.path] = (key, result)
+	return result
+
+
+def parse_hil_file(text):
+	# The name of every trait declared in the file.
+	return [match.group(1) for match in TRAIT_RE.finditer(text)]
+
+
+def parse_chip_file(text):
+	# Every word in the text before " for " of any `impl ... for ...` line.
+	items = set()
+	for match in IMPL_RE.finditer(text):
+		# Split the text before " for " apart from all other symbols
+		items.update(TOKEN_RE.findall(match.group(1)))
+	# Sorted so it can be stored in the JSON cache.
+	return sorted(items)
+
+
+script_stat = os.stat(__file__)
+script_key = [script_stat.st_mtime_ns, script_stat.st_size]
+old_files = load_cache()
+new_files = {}
 
 hils = {}
 
 # Get the name of all HILs
-for subdir, dirs, files in os.walk(os.fsencode('kernel/src/hil/')):
-	for file in files:
-		filepath = os.fsdecode(os.path.join(subdir, file))
-
-		if filepath.endswith('.rs'):
-			with open(filepath) as f:
-				mod = os.path.splitext(os.path.basename(filepath))[0]
-				for l in f:
-					if l.startswith('pub trait'):
-						items = re.findall(r"[A-Za-z0-9]+|\S", l)
-
-						hil_name = items[2]
-						if not 'Client' in hil_name:
-							hils[hil_name] = {'module': mod, 'chips': []}
-
-chips = []
-
-# Get each chip and all HILs that chip implements.
-for subdir, dirs, files in os.walk(os.fsencode('chips/')):
-	for file in files:
-		filepath = os.fsdecode(os.path.join(subdir, file))
-
-		if '/src/' in filepath and filepath.endswith('.rs'):
-			chip = filepath.split('/')[1]
-			chips.append(chip)
-
-			with open(filepath) as f:
-				for l in f:
-					# Find any line with `impl`
-					if l.startswith('impl') and ' for ' in l:
-
-						# Get the text before " for "
-						half = l.split(' for ')[0]
-						# Split strings apart from all other symbols
-						items = re.findall(r"[A-Za-z0-9]+|\S", half)
-
-						# Check each HIL to see if this `impl` line implements
-						# that HIL.
-						for hil in hils.keys():
-							for item in items:
-								if item == hil:
-									hils[hil]['chips'].append(chip)
-									break
+for entry in walk_rs('kernel/src/hil/'):
+	mod = entry.name[:-len('.rs')]
+	for hil_name in parse_cached(entry, parse_hil_file):
+		if not 'Client' in hil_name:
+			hils[hil_name] = {'module': mod, 'chips': set()}
+
+chips = set()
+
+# Get each chip and all HILs that chip implements. Only the `src/`
+# directory of each chip crate is walked, which skips build artifacts and
+# anything else in the crate.
+for chip_entry in os.scandir('chips/'):
+	src_dir = os.path.join(chip_entry.path, 'src')
+	if not chip_entry.is_dir() or not os.path.isdir(src_dir):
+		continue
+	chip = chip_entry.name
+
+	for entry in walk_rs(src_dir):
+		chips.add(chip)
+
+		# Find every HIL any `impl` line in this file implements.
+		for hil in hils.keys() & parse_cached(entry, parse_chip_file):
+			hils[hil]['chips'].add(chip)
 
 # Calculate chips that should be ignored since they only support other chips.
-subsumed = []
-for k,v in SUBSUMES.items():
-	subsumed += v
+subsumed = set().union(*SUBSUMES.values())
 
 # Get only proper chips that are not just crates that support other chips.
-chips = set(chips).difference(subsumed)
+chips = sorted(chips.difference(subsumed))
+
+# For each column, the chip crates whose `impl`s count towards that chip:
+# the chip itself and any chips it subsumes.
+column_crates = [{chip} | SUBSUMES.get(chip, set()) for chip in chips]
 
 # Setup table and add the header row.
 table = []
-table.append(['HIL', *sorted(chips)])
+table.append(['HIL', *chips])
 
 # Add rows to the table, one row for each HIL.
 for k,v in sorted(hils.items(), key=lambda x: '{}::{}'.format(x[1]['module'], x[0])):
-	row = ['{}::{}'.format(v['module'], k)]
+	supported = [not crates.isdisjoint(v['chips']) for crates in column_crates]
 
 	# Skip any HILs that have no chip support. These are likely not HILs
 	# that hardware chips implement.
-	at_least_one = False
+	if any(supported):
+		row = ['{}::{}'.format(v['module'], k)]
+		row.extend('✓' if s else ' ' for s in supported)
+		table.append(row)
 
-	for chip in sorted(chips):
-		# Check if this chip or if any chip it subsumes implements this HIL.
-		if chip in v['chips'] or (chip in SUBSUMES and len(set(SUBSUMES[chip]).intersection(set(v['chips'])))):
-			at_least_one = True
-			row.append('✓')
-		else:
-			row.append(' ')
+# Calculate the max widths of each column. The other columns we just need
+# to look at the header.
+widths = [len(item) for item in table[0]]
+widths[0] = max(len(row[0]) for row in table)
 
-	if at_least_one:
-		table.append(row)
+# Use the widths to pad each item in each row.
+row_format = ''.join('| {{:<{}s}}'.format(width+1) for width in widths) + '|\n'
 
-# Calculate the max widths of each column.
-widths = [0]*len(table[0])
-for row in table:
-	widths[0] = max(len(row[0]), widths[0])
-# The other columns we just need to look at the header
-for i,item in enumerate(table[0]):
-	widths[i] = max(len(item), widths[i])
-
-# Generate the output table.
-out = ''
-for i,row in enumerate(table):
-	# Use the widths to pad each item in each row.
-	for j,item in enumerate(row):
-		out += '| '
-		out += '{1:<{0}s}'.format(widths[j]+1, item)
-
-	out += '|\n'
-
-	# After the first row add the "----" header marking row.
-	if i == 0:
-		for width in widths:
-			out += '|'
-			out += '-'*(width+2)
-		out += '|\n'
-
-# Update the chips README with the newly calculate table.
-readme_first = ''
-readme_second = ''
+# Generate the output table. After the first row add the "----" header
+# marking row.
+lines = [row_format.format(*table[0])]
+lines.append(''.join('|' + '-'*(width+2) for width in widths) + '|\n')
+lines.extend(row_format.format(*row) for row in table[1:])
+out = ''.join(lines)
+
+# Update the chips README with the newly calculate table. Copy it to a
+# temporary file, replacing what is between the markers, and then move that
+# over the original so an error never leaves a half-written README.
 readme_state = 'start'
-with open('chips/README.md') as f:
+with open('chips/README.md') as f, open('chips/README.md.tmp', 'w') as out_f:
 	for l in f:
 		if readme_state == 'end':
-			readme_second += l
+			out_f.write(l)
 		elif '<!--END OF HIL SUPPORT-->' in l:
 			readme_state = 'end'
-			readme_second += '\n'
-			readme_second += l
+			out_f.write(out)
+			out_f.write('\n')
+			out_f.write(l)
 		elif '<!--START OF HIL SUPPORT-->' in l:
 			readme_state = 'skip'
-			readme_first += l
-			readme_first += '\n'
+			out_f.write(l)
+			out_f.write('\n')
 		elif readme_state == 'start':
-			readme_first += l
+			out_f.write(l)
+
+	# Without an end marker the table goes at the end, as it always has.
+	if readme_state != 'end':
+		out_f.write(out)
+
+os.replace('chips/README.md.tmp', 'chips/README.md')
 
-with open('chips/README.md', 'w') as f:
-	f.write(readme_first)
-	f.write(out)
-	f.write(readme_second)
+# Save what was parsed for the next run. Files that no longer exist are
+# dropped, as only the files seen this run are saved.
+os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+with open(CACHE_PATH, 'w') as f:
+	json.dump({'script': script_key, 'files': new_files}, f)